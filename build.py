@@ -1,12 +1,21 @@
 import os
+import sys
 import shutil
 import json
 import struct
+import io
+import hashlib
+import argparse
+import multiprocessing
+import subprocess
+import tempfile
 from pathlib import Path
 from typing import Dict, List
 from utils.fontgen import Font, FontType
 import utils.fontgen as fg
 from utils.pbpack import ResourcePack
+from utils.pomo import compile_po_file, load_mo
+from utils.procstats import format_rss, peak_rss_kib
 
 LANG_DIR = Path('./lang/')
 TTFS_DIR = Path('./ttf/')
@@ -14,28 +23,84 @@ PBFFS_DIR = Path('./pbff/')
 BUILD_DIR = Path('./build/')
 TRANS_DIR = Path('./translation/')
 OUTPUT_FILE = 'langpack.pbl'
+HASH_FILE = OUTPUT_FILE + '.sha256'
 USE_EXTENDED = True
 USE_LEGACY = False
-
+TRIM_GLYPHS = True
+# printable ASCII, provided by the watch's built-in fonts that the pack only extends
+SYSTEM_FONT_CODEPOINTS = range(fg.MIN_CODEPOINT, 0x80)
+
+parser = argparse.ArgumentParser(description='Build a Pebble language pack')
+parser.add_argument('--verify-reproducible', action='store_true',
+                    help='build again in a separate process and fail if the outputs differ')
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help='number of worker processes rendering font sizes in parallel')
+parser.add_argument('--translations-only', action='store_true',
+                    help='only repack the translation, reusing the font resources already in build/')
+parser.add_argument('--compile-po', action='store_true',
+                    help='compile translation/*.po instead of using the prebuilt translation/000')
+parser.add_argument('--build-dir', default=str(BUILD_DIR),
+                    help='directory the resources and the pack are written to')
+args = parser.parse_args()
+
+BUILD_DIR = Path(args.build_dir)
+MO_CACHE_DIR = BUILD_DIR / 'mo_cache'
 os.makedirs(BUILD_DIR, exist_ok=True)
 
-def build_font_objects(json_paths, font_height, font_offset, pbff_type) -> List[Font]:
+def reference_build(reference_dir: Path):
+    """
+    Builds into reference_dir in a fresh interpreter, before this build
+    overwrites anything a resource source may read from BUILD_DIR
+    """
+    build_args = ['--build-dir', str(reference_dir), '--jobs', str(args.jobs)]
+    if args.compile_po:
+        build_args.append('--compile-po')
+    if args.translations_only:
+        build_args.append('--translations-only')
+        for key in [str(i).zfill(3) for i in range(1, 9)] + [OUTPUT_FILE]:
+            if (BUILD_DIR / key).exists():
+                shutil.copy(BUILD_DIR / key, reference_dir / key)
+    result = subprocess.run([sys.executable, sys.argv[0]] + build_args,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        print(result.stdout)
+        raise Exception("Reference build for --verify-reproducible failed")
+
+if args.verify_reproducible:
+    reference_tmp = tempfile.TemporaryDirectory(prefix='pbl_reference_')
+    print("Building reference for reproducibility check in " + reference_tmp.name)
+    reference_build(Path(reference_tmp.name))
+
+def format_codepoints(codepoints, limit=16) -> str:
+    """The first `limit` codepoints as U+XXXX, followed by how many more there are"""
+    listed = ' '.join(f"U+{cp:04X}" for cp in codepoints[:limit])
+    more = f" (+{len(codepoints) - limit} more)" if len(codepoints) > limit else ""
+    return listed + more
+
+def build_font_objects(json_paths, font_height, font_offset, pbff_type, resource_key) -> List[Font]:
     font_objects = []
     
     for json_path in json_paths:
         font_or_pbff_name: str = json_path.name.replace(".json", "")
         ttf_path = ""
         pbff_path = ""
-        if '.ttf' in font_or_pbff_name:
+        resource_path = ""
+        if font_or_pbff_name.endswith('.resource'):
+            font_type = FontType.RESOURCE
+            with open(json_path, 'r', encoding='utf-8') as f:
+                resource_path = json.load(f)["font"]
+        elif '.ttf' in font_or_pbff_name:
             font_type = FontType.TTF
             ttf_path = str(TTFS_DIR / font_or_pbff_name)
         elif '.pbff' in font_or_pbff_name:
             font_type = FontType.PBFF
             pbff_path = str(PBFFS_DIR.joinpath(font_or_pbff_name.replace(".pbff", "")).joinpath(f"{pbff_type}.pbff"))
 
-        max_glyphs = 32640 if USE_EXTENDED else 256
-        font_obj = Font(font_type, ttf_path, pbff_path, font_height, max_glyphs, USE_LEGACY)
+        max_glyphs = fg.MAX_GLYPHS_EXTENDED if USE_EXTENDED else fg.MAX_GLYPHS
+        font_obj = Font(font_type, ttf_path, pbff_path, font_height, max_glyphs, USE_LEGACY,
+                        resource_path=resource_path, resource_key=resource_key)
         font_obj.set_codepoint_list(json_path)
+        font_obj.set_trim(TRIM_GLYPHS)
         if font_offset is not None:
             font_obj.set_heightoffset(font_offset)
         
@@ -61,7 +126,7 @@ def merge_fonts(fonts: List[Font]) -> Font:
                 m.offset_tables[glyph_hash].append(struct.pack(offset_table_format, codepoint, offset))
                 bucket_sizes[glyph_hash] += 1
                 if bucket_sizes[glyph_hash] > fg.OFFSET_TABLE_MAX_SIZE:
-                    print(f"error: {bucket_sizes[glyph_hash]} > 127")
+                    raise Exception(f"Hash bucket {glyph_hash} has {bucket_sizes[glyph_hash]} entries, the limit is {fg.OFFSET_TABLE_MAX_SIZE}")
             return bucket_sizes
 
         def add_glyph(m:Font, f:Font, codepoint, next_offset, gindex, glyph_indices_lookup):
@@ -69,6 +134,8 @@ def merge_fonts(fonts: List[Font]) -> Font:
             if (id(f), gindex) not in glyph_indices_lookup:
                 if f.type == FontType.TTF:
                     glyph_bits = f.glyph_bits_ttf(gindex)
+                elif f.type == FontType.RESOURCE:
+                    glyph_bits = f.glyph_bits_resource(codepoint)
                 else:  # assuming PBFF
                     glyph_bits = f.glyph_bits_pbff(codepoint)
                 glyph_indices_lookup[(id(f), gindex)] = offset
@@ -83,6 +150,32 @@ def merge_fonts(fonts: List[Font]) -> Font:
             m.number_of_glyphs += 1
             return offset, next_offset, glyph_indices_lookup
 
+        def fit_to_format_limits(m:Font, owners):
+            # Keep codepoints in ownership order while they fit the font format:
+            # max_glyphs, OFFSET_TABLE_MAX_SIZE entries per hash bucket and offset
+            # table offsets that fit the 16 bit field of the hash table
+            codepoint_bytes = 4 if max(owners) > fg.MAX_2_BYTES_CODEPOINT else 2
+            entry_size = fg.OFFSET_SIZE_BYTES + codepoint_bytes
+            bucket_sizes = [0] * m.table_size
+            entries_before_last_bucket = 0
+            fitted = {}
+            dropped = []
+            for codepoint, owner in owners.items():
+                glyph_hash = fg.hasher(codepoint, m.table_size)
+                before_last_bucket = glyph_hash < m.table_size - 1
+                if (len(fitted) >= m.max_glyphs
+                        or bucket_sizes[glyph_hash] >= fg.OFFSET_TABLE_MAX_SIZE
+                        or (before_last_bucket
+                            and (entries_before_last_bucket + 1) * entry_size > fg.MAX_OFFSET_TABLE_OFFSET)):
+                    dropped.append(codepoint)
+                    continue
+                fitted[codepoint] = owner
+                bucket_sizes[glyph_hash] += 1
+                entries_before_last_bucket += before_last_bucket
+            if dropped:
+                print(f"warning: {len(dropped)} codepoints do not fit the font format limits and were dropped: {format_codepoints(dropped)}")
+            return fitted
+
         def codepoint_is_in_subset(f:Font, codepoint):
             if codepoint not in (fg.WILDCARD_CODEPOINT, fg.ELLIPSIS_CODEPOINT):
                 if f.regex is not None:
@@ -109,53 +202,49 @@ def merge_fonts(fonts: List[Font]) -> Font:
         merged.name = b"merged_font"
         merged.heightoffset = fonts[0].heightoffset
         
+        # Resolve codepoint -> (font, glyph index) ownership in one pass over
+        # the coverage indexes, the first font providing a codepoint wins
+        owners = {fg.WILDCARD_CODEPOINT: (fonts[0], 0)}
+        for thisfont in fonts:
+            for codepoint, gindex in thisfont.coverage().items():
+                if codepoint == fg.WILDCARD_CODEPOINT and thisfont.type == FontType.TTF:
+                    raise Exception(f'Wildcard codepoint is used for something else in this font {thisfont.ttf_path or thisfont.pbff_path}')
+                if codepoint in owners or not codepoint_is_in_subset(thisfont, codepoint):
+                    continue
+                owners[codepoint] = (thisfont, gindex)
+        owners = fit_to_format_limits(merged, owners)
+
         glyph_entries = []
         merged.glyph_table.append(struct.pack('<I', 0))
         merged.number_of_glyphs = 0
         glyph_indices_lookup: Dict[int, int] = {}
-        offset, next_offset, glyph_indices_lookup = add_glyph(merged, fonts[0], fg.WILDCARD_CODEPOINT, 4, 0, glyph_indices_lookup)
-        glyph_entries.append((fg.WILDCARD_CODEPOINT, offset))
-        next_offset = 4 + len(merged.glyph_table[-1])
-
-        for thisfont in fonts:
-            codepoint, gindex = thisfont.get_first_char()
+        next_offset = 4
 
-            while gindex:
-                if merged.number_of_glyphs > merged.max_glyphs:
-                    break
-
-                if codepoint == fg.WILDCARD_CODEPOINT:
-                    if thisfont.type == FontType.TTF:
-                        raise Exception(f'Wildcard codepoint is used for something else in this font {thisfont.ttf_path or thisfont.pbff_path}')
-                    # continue
-
-                if gindex == 0:
-                    raise Exception('0 index is reused by a non wildcard glyph')
-
-                if codepoint_is_in_subset(thisfont, codepoint):
-                    offset, next_offset, glyph_indices_lookup = add_glyph(merged, thisfont, codepoint, next_offset, gindex, glyph_indices_lookup)
-                    glyph_entries.append((codepoint, offset))
-
-                codepoint, gindex = thisfont.get_next_char(codepoint, gindex)
+        for codepoint, (thisfont, gindex) in owners.items():
+            offset, next_offset, glyph_indices_lookup = add_glyph(merged, thisfont, codepoint, next_offset, gindex, glyph_indices_lookup)
+            glyph_entries.append((codepoint, offset))
 
         sorted_entries = sorted(glyph_entries, key=lambda entry: entry[0])
         hash_bucket_sizes = build_offset_tables(merged, sorted_entries)
         build_hash_table(merged, hash_bucket_sizes)
+        merged.trimmed_bytes = sum(f.trimmed_bytes for f in fonts)
         return merged
 
 glyph_map_ttf = {}
 glyph_map_pbff = {}
+glyph_map_resource = {}
 
 # Build codepoint -> font map
 
 print("Building codepoint list")
 
 # Read all *.txt files in './lang/'
-for filename in os.listdir(LANG_DIR):
+for filename in sorted(os.listdir(LANG_DIR)):
     if filename.endswith('.txt'):
         with open(LANG_DIR/filename, 'r', encoding='utf-8') as f:
             ttf_name = None
             pbff_name = None
+            resource_name = None
             for line in f:
                 line = line.strip()
                 if line.startswith('#') or line == '':
@@ -163,14 +252,18 @@ for filename in os.listdir(LANG_DIR):
                         ttf_name = line.split(':', 1)[1].strip()
                     if line.startswith('#pbff:'):
                         pbff_name = line.split(':', 1)[1].strip()
+                    if line.startswith('#resource:'):
+                        resource_name = line.split(':', 1)[1].strip()
                     continue
-                if ttf_name is None and pbff_name is None:
+                if ttf_name is None and pbff_name is None and resource_name is None:
                     raise Exception('Font file not specified in ' + filename)
                 for ch in line:
                     if ttf_name:
                         glyph_map_ttf[ord(ch)] = ttf_name
                     if pbff_name:
                         glyph_map_pbff[ord(ch)] = pbff_name
+                    if resource_name:
+                        glyph_map_resource[ord(ch)] = resource_name
 
 # Read './lang/unicodes.json'
 unicodes_path = LANG_DIR/'unicodes.json'
@@ -182,22 +275,28 @@ for spec in unicode_specs:
     end_cp = int(spec['end'], 16)
     ttf_name = spec.get('ttf')
     pbff_name = spec.get('pbff')
-    if ttf_name is None and pbff_name is None:
-        raise KeyError(f'unicode spec with name {spec.get('name')} must have "font" or "pbff" specified')
-    if ttf_name != None and pbff_name != None:
-        raise KeyError(f'unicode spec with name {spec.get('name')} must have either "font" or "pbff", not both')
+    resource_name = spec.get('resource')
+    sources = [name for name in (ttf_name, pbff_name, resource_name) if name is not None]
+    if len(sources) == 0:
+        raise KeyError(f'unicode spec with name {spec.get('name')} must have "ttf", "pbff" or "resource" specified')
+    if len(sources) > 1:
+        raise KeyError(f'unicode spec with name {spec.get('name')} must have only one of "ttf", "pbff" or "resource"')
 
     for cp in range(start_cp, end_cp + 1):
         if ttf_name:
             glyph_map_ttf[cp] = ttf_name
         if pbff_name:
             glyph_map_pbff[cp] = pbff_name
+        if resource_name:
+            glyph_map_resource[cp] = resource_name
 
 glyph_inv_ttf = {}
 glyph_inv_pbff = {}
+glyph_inv_resource = {}
 
 # Build the inverse mappings
-for glyph_map, glyph_inv in [(glyph_map_ttf, glyph_inv_ttf), (glyph_map_pbff, glyph_inv_pbff)]:
+for glyph_map, glyph_inv in [(glyph_map_ttf, glyph_inv_ttf), (glyph_map_pbff, glyph_inv_pbff),
+                             (glyph_map_resource, glyph_inv_resource)]:
     for key, value in glyph_map.items():
         if value not in glyph_inv:
             glyph_inv[value] = []
@@ -206,7 +305,8 @@ for glyph_map, glyph_inv in [(glyph_map_ttf, glyph_inv_ttf), (glyph_map_pbff, gl
 json_paths = []
 
 # Build font -> codepoint map
-for glyph_inv, font_type in [(glyph_inv_ttf, FontType.TTF), (glyph_inv_pbff, FontType.PBFF)]:
+for glyph_inv, font_type in [(glyph_inv_ttf, FontType.TTF), (glyph_inv_pbff, FontType.PBFF),
+                             (glyph_inv_resource, FontType.RESOURCE)]:
     for ttf_name, codepoints in glyph_inv.items():
         # Sort codepoints for consistent output
         sorted_codepoints = sorted(list(codepoints))
@@ -226,6 +326,9 @@ for glyph_inv, font_type in [(glyph_inv_ttf, FontType.TTF), (glyph_inv_pbff, Fon
 
         if font_type == FontType.TTF:
             output_path = BUILD_DIR / f"{ttf_name}.json"
+        elif font_type == FontType.RESOURCE:
+            # the source path is read back from "font"
+            output_path = BUILD_DIR / f"{ttf_name.replace('/', '_').replace(os.sep, '_')}.resource.json"
         else:  # PBFF
             output_path = BUILD_DIR / f"{ttf_name}.pbff.json"
 
@@ -243,6 +346,7 @@ print("Building resource")
 
 builds = {
     # pebble font resource key: (ttf font height, ttf height offset, pbff file name)
+    # resource sources provide the resource with the same key
     '001': (12, 2, '14'),
     '002': (12, 2, '14_bold'),
     '003': (14, 4, '18'),
@@ -253,36 +357,147 @@ builds = {
     '008': (20, 8, '28_bold'),
 }
 
-for key, values in builds.items():
+def build_fonts(key, values) -> List[Font]:
     fonts = build_font_objects(
         json_paths,
         font_height=values[0],
         font_offset=values[1],
         pbff_type=values[2],
+        resource_key=key,
     )
     if not fonts:
         raise Exception("Failed to create any Font objects. Exiting.")
-        
+    return fonts
+
+def report_uncovered(key, fonts: List[Font]):
+    for f in fonts:
+        uncovered = f.uncovered_codepoints()
+        if uncovered:
+            print(f"warning: {key}: {f.ttf_path or f.pbff_path or f.resource_path} has no glyph for {len(uncovered)} requested codepoints: {format_codepoints(uncovered)}")
+
+def build_font_resource(fonts: List[Font]) -> Font:
     merged_font = merge_fonts(fonts)
     if merged_font is None:
         raise Exception("Failed to merge fonts. Exiting.")
-    
+
+    return merged_font
+
+def write_font_resource(key):
+    """Renders and writes one font size, runs in a worker process when --jobs > 1"""
+    merged_font = build_font_resource(font_sets[key])
     with open(BUILD_DIR / key, 'wb') as f:
         f.write(merged_font.bitstring())
+    return key, merged_font.trimmed_bytes, f"worker {os.getpid()} {format_rss()}"
+
+def compile_translations():
+    """Compiles translation/*.po to build/<name> (MO), cached by .po hash"""
+    os.makedirs(MO_CACHE_DIR, exist_ok=True)
+    for po_path in sorted(TRANS_DIR.glob('*.po')):
+        cached_mo = MO_CACHE_DIR / f"{po_path.stem}.{fg.file_hash(str(po_path))}.mo"
+        if not cached_mo.exists():
+            print(f"Compiling {po_path}")
+            tmp_path = cached_mo.with_suffix('.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(compile_po_file(str(po_path)))
+            os.replace(tmp_path, cached_mo)
+        shutil.copy(cached_mo, BUILD_DIR / po_path.stem)
+
+def report_untranslatable(key):
+    """
+    Warns about characters of translation `key` that neither the system fonts
+    nor the font resources have a glyph for, once per set of affected sizes
+    """
+    chars = set()
+    for msgid, msgstr in load_mo(open(BUILD_DIR / key, 'rb').read()):
+        if msgid != '':  # the header is not displayed
+            chars.update(ord(ch) for ch in msgstr
+                         if ord(ch) >= fg.MIN_CODEPOINT and ord(ch) not in SYSTEM_FONT_CODEPOINTS)
+    font_keys_by_uncovered: Dict[tuple, List[str]] = {}
+    for font_key in builds:
+        covered = fg.load_font_resource(open(BUILD_DIR / font_key, 'rb').read())
+        uncovered = tuple(sorted(cp for cp in chars if cp not in covered))
+        if uncovered:
+            font_keys_by_uncovered.setdefault(uncovered, []).append(font_key)
+    for uncovered, font_keys in font_keys_by_uncovered.items():
+        print(f"warning: {', '.join(font_keys)}: no glyph for {len(uncovered)} characters of translation {key}: {format_codepoints(uncovered)}")
+
+def build_pack() -> bytes:
+    pack = ResourcePack()
+    for f in [str(i).zfill(3) for i in range(0, 19)]:
+        pack.add_resource(open(BUILD_DIR / f, 'rb').read())
+    with io.BytesIO() as pack_file:
+        pack.serialize(pack_file)
+        return pack_file.getvalue()
+
+if args.translations_only:
+    missing = [key for key in builds if not (BUILD_DIR / key).exists()]
+    if missing:
+        raise Exception("No previous build of font resources " + ", ".join(missing) + ". Run a full build first.")
+else:
+    font_sets = {key: build_fonts(key, values) for key, values in builds.items()}
+    for key, fonts in font_sets.items():
+        report_uncovered(key, fonts)
+
+    jobs = args.jobs
+    if jobs > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        print("warning: parallel builds need fork(), building sequentially")
+        jobs = 1
+    if jobs > 1:
+        # Forked workers inherit the loaded fonts, TTF faces read the font
+        # files through shared memory maps instead of private copies
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            results = list(pool.imap(write_font_resource, builds))
+    else:
+        results = map(write_font_resource, builds)
+
+    for key, trimmed_bytes, worker_rss in results:
+        if TRIM_GLYPHS:
+            print(f"{key}: trimmed {trimmed_bytes} bytes of empty glyph rows and columns")
+        if jobs > 1:
+            print(f"{key}: built by {worker_rss}")
 
 for file_name in [str(i).zfill(3) for i in range(9, 19)]:
     with open(BUILD_DIR / file_name, 'w') as f:
         pass  # Empty file
 
-shutil.copy(TRANS_DIR / '000', BUILD_DIR / '000')
+if args.compile_po:
+    compile_translations()
+if not (args.compile_po and (TRANS_DIR / '000.po').exists()):
+    # the shipped 000.po is a template with example translations, so the
+    # prebuilt MO file is packed unless compiling is asked for
+    shutil.copy(TRANS_DIR / '000', BUILD_DIR / '000')
+report_untranslatable('000')
 
 print("Packing resources")
 
-# Pack all files
-pack = ResourcePack()
-for f in [str(i).zfill(3) for i in range(0, 19)]:
-    pack.add_resource(open(BUILD_DIR / f, 'rb').read())
-with open(BUILD_DIR / OUTPUT_FILE, 'wb') as pack_file:
-    pack.serialize(pack_file)
-
-print("Completed. Output: " + str(BUILD_DIR / OUTPUT_FILE))
+if args.translations_only and (BUILD_DIR / OUTPUT_FILE).exists():
+    # Only the translation changed, swap it into the previous pack
+    ResourcePack.replace_resource(BUILD_DIR / OUTPUT_FILE, BUILD_DIR / OUTPUT_FILE, 1,
+                                  open(BUILD_DIR / '000', 'rb').read())
+    pack_bytes = open(BUILD_DIR / OUTPUT_FILE, 'rb').read()
+else:
+    # Pack all files
+    pack_bytes = build_pack()
+    with open(BUILD_DIR / OUTPUT_FILE, 'wb') as pack_file:
+        pack_file.write(pack_bytes)
+
+# Content hash so downstream caches can skip unchanged packs (sha256sum format)
+pack_hash = hashlib.sha256(pack_bytes).hexdigest()
+with open(BUILD_DIR / HASH_FILE, 'w') as hash_file:
+    hash_file.write(f"{pack_hash}  {OUTPUT_FILE}\n")
+
+if args.verify_reproducible:
+    print("Verifying reproducibility")
+    reference_dir = Path(reference_tmp.name)
+    mismatches = []
+    for name in [str(i).zfill(3) for i in range(0, 19)] + [OUTPUT_FILE, HASH_FILE]:
+        if open(reference_dir / name, 'rb').read() != open(BUILD_DIR / name, 'rb').read():
+            mismatches.append(name)
+    reference_tmp.cleanup()
+    if mismatches:
+        print("error: build is not reproducible, differing outputs: " + ", ".join(mismatches))
+        sys.exit(1)
+    print("Build is reproducible")
+
+print(f"Peak RSS {peak_rss_kib() / 1024:.1f} MiB")
+print("Completed. Output: " + str(BUILD_DIR / OUTPUT_FILE) + " (sha256 " + pack_hash + ")")
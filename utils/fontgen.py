@@ -1,18 +1,20 @@
 # Source: https://gist.github.com/medicalwei/c9fdcd9ec19b0c363ec1
 
 import argparse
+import ctypes
 from enum import Enum
-from typing import Any
 import freetype
+import hashlib
+import mmap
 import os
 import re
 import struct
 import sys
-import itertools
 import json
 from math import ceil
 
 from utils.io import LinedFileReader
+from utils.pbpack import ResourcePack
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '../'))
 # import generate_c_byte_array
@@ -30,26 +32,76 @@ OFFSET_TABLE_MAX_SIZE = 128
 MAX_GLYPHS_EXTENDED = HASH_TABLE_SIZE * OFFSET_TABLE_MAX_SIZE
 MAX_GLYPHS = 256
 OFFSET_SIZE_BYTES = 4
-
-
-def grouper(n, iterable, fillvalue=None):
-    """grouper(3, 'ABCDEFG', 'x') --> ABC DEF Gxx"""
-    args = [iter(iterable)] * n
-    return itertools.zip_longest(*args, fillvalue=fillvalue)
+MAX_OFFSET_TABLE_OFFSET = 0xffff  # hash table entries store offset table offsets in 16 bits
+FONT_INFO_FMT = '<BBHHBB'
+HASH_TABLE_ENTRY_FMT = '<BBH'
+GLYPH_HEADER_FMT = '<BBbbb'
+GLYPH_HEADER_SIZE = struct.calcsize(GLYPH_HEADER_FMT)
 
 
 def hasher(codepoint, num_glyphs):
     return (codepoint % num_glyphs)
 
 
-def bits(x):
-    data = []
-    for i in range(8):
-        data.insert(0, int((x & 1) == 1))
-        x = x >> 1
-    return data
+def bitmap_record_size(width, height):
+    return GLYPH_HEADER_SIZE + ceil(width * height / 32) * 4
+
+
+# Bit-reversed value of every byte, FreeType rows are MSB-first
+REVERSED_BITS = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+
 
-def load_pbff_file(path: str) -> dict[int, dict[str, Any]]:
+class Glyph:
+    """
+    Glyph metrics and 1-bit bitmap. Each row is an int with bit x set for
+    pixel x, which is the bit order of the Pebble glyph bitmap.
+    """
+    __slots__ = ('width', 'height', 'left', 'top', 'advance', 'rows')
+
+    def __init__(self, width: int, height: int, left: int, top: int, advance: int, rows: list[int]):
+        self.width = width
+        self.height = height
+        self.left = left
+        self.top = top
+        self.advance = advance
+        self.rows = rows
+
+    def trim(self) -> 'Glyph':
+        """
+        Crops the bitmap to the bounding box of its set bits and moves the
+        offsets so the glyph renders at the same pixels. An empty bitmap is
+        reduced to 0x0.
+        """
+        ink_rows = [y for y, row in enumerate(self.rows) if row]
+        if not ink_rows:
+            return Glyph(0, 0, self.left, self.top, self.advance, [])
+        first_row, last_row = ink_rows[0], ink_rows[-1]
+        ink = 0
+        for row in self.rows:
+            ink |= row
+        first_col = (ink & -ink).bit_length() - 1
+        width = ink.bit_length() - first_col
+        return Glyph(width,
+                     last_row - first_row + 1,
+                     self.left + first_col,
+                     self.top + first_row,
+                     self.advance,
+                     [row >> first_col for row in self.rows[first_row:last_row + 1]])
+
+    def record_size(self) -> int:
+        return bitmap_record_size(self.width, self.height)
+
+    def pack(self) -> bytes:
+        """Glyph header followed by the bitmap, padded to 32 bits"""
+        bitmap = 0
+        mask = (1 << self.width) - 1
+        for y, row in enumerate(self.rows):
+            bitmap |= (row & mask) << (y * self.width)
+        return (struct.pack(GLYPH_HEADER_FMT, self.width, self.height, self.left, self.top, self.advance)
+                + bitmap.to_bytes(self.record_size() - GLYPH_HEADER_SIZE, 'little'))
+
+
+def load_pbff_file(path: str) -> dict[int, Glyph]:
     """
     Source: https://github.com/pebble-dev/renaissance/blob/master/lib/pbff.py
     
@@ -85,7 +137,7 @@ def load_pbff_file(path: str) -> dict[int, dict[str, Any]]:
             r = re.match(r'^glyph (\d+)', line)
             if r:
                 glyph_codepoint = int(r.group(1))
-                data = []
+                rows = []
                 # 3rd capture group should accept negative numbers, such as -1
                 r = re.match(r'^(\s*)(-+|\.)\s*(-?\d+)$', f1.next())
                 if r:
@@ -95,39 +147,23 @@ def load_pbff_file(path: str) -> dict[int, dict[str, Any]]:
                     r = re.match(r'^([ #]*)$', f1.peek())
                     while r:
                         f1.next()
-                        data += [[True if x == '#' else False
-                                for x in r.group(1)]]
+                        # '#' at column x sets bit x
+                        rows.append(int(r.group(1)[::-1].replace('#', '1').replace(' ', '0') or '0', 2))
                         r = re.match(r'^([ #]*)$', f1.peek())
-                    first_enabled = None
-                    last_enabled = 0
-                    for bmpline in data:
-                        idx = 0
-                        for char in bmpline:
-                            if char and (first_enabled is None or idx < first_enabled):
-                                first_enabled = idx
-                            if char and idx > last_enabled:
-                                last_enabled = idx
-                            idx += 1
-                    for bmpline in data:
-                        while len(bmpline) <= last_enabled:
-                            bmpline += [False]
-                    data = [x[first_enabled:] for x in data]
-                    if first_enabled is None:
-                        left = 0
-                        width = 0
-                        height = 0
+                    ink = 0
+                    for row in rows:
+                        ink |= row
+                    if ink == 0:
+                        glyphs[glyph_codepoint] = Glyph(0, 0, 0, top, advance, [])
                     else:
-                        left = first_enabled - negativeLeft
-                        width = last_enabled - first_enabled + 1
-                        height = len(data)
-                    glyphs[glyph_codepoint] = {
-                        'top': top,
-                        'data': data,
-                        'left': left,
-                        'width': width,
-                        'height': height,
-                        'advance': advance
-                    }
+                        # drop empty columns on the left and right
+                        first_enabled = (ink & -ink).bit_length() - 1
+                        glyphs[glyph_codepoint] = Glyph(ink.bit_length() - first_enabled,
+                                                        len(rows),
+                                                        first_enabled - negativeLeft,
+                                                        top,
+                                                        advance,
+                                                        [row >> first_enabled for row in rows])
                 else:
                     print(f'glyph_codepoint {glyph_codepoint}')
                     print(f'path {path}')
@@ -135,10 +171,124 @@ def load_pbff_file(path: str) -> dict[int, dict[str, Any]]:
         return glyphs
 
 
+def glyph_record_size(data: bytes, offset: int) -> int:
+    """Size of the glyph record (header + 32-bit padded bitmap) at offset"""
+    return bitmap_record_size(data[offset], data[offset + 1])
+
+
+def load_font_resource(data: bytes) -> dict[int, bytes]:
+    """
+    Parses a built Pebble font resource (as written by Font.bitstring)
+    into a codepoint -> glyph record bytes mapping.
+    """
+    info_size = struct.calcsize(FONT_INFO_FMT)
+    if len(data) < info_size:
+        raise ValueError('Font resource is too short')
+    (version, _, number_of_glyphs, _,
+     table_size, codepoint_bytes) = struct.unpack_from(FONT_INFO_FMT, data)
+    if version != FONT_VERSION_2:
+        raise ValueError(f'Unsupported font resource version {version}')
+    if codepoint_bytes not in (2, 4) or table_size == 0:
+        raise ValueError('Invalid font resource header')
+
+    offset_entry_fmt = '<LL' if codepoint_bytes == 4 else '<HL'
+    offset_entry_size = struct.calcsize(offset_entry_fmt)
+    hash_table_size = struct.calcsize(HASH_TABLE_ENTRY_FMT)
+    offset_tables_start = info_size + table_size * hash_table_size
+    glyph_table_start = offset_tables_start + number_of_glyphs * offset_entry_size
+    if glyph_table_start > len(data):
+        raise ValueError('Font resource tables exceed resource length')
+
+    glyphs = {}
+    number_of_entries = 0
+    for i in range(table_size):
+        _, bucket_size, bucket_offset = struct.unpack_from(
+            HASH_TABLE_ENTRY_FMT, data, info_size + i * hash_table_size)
+        number_of_entries += bucket_size
+        if offset_tables_start + bucket_offset + bucket_size * offset_entry_size > glyph_table_start:
+            raise ValueError(f'Offset table of hash bucket {i} is out of bounds')
+        for j in range(bucket_size):
+            codepoint, glyph_offset = struct.unpack_from(
+                offset_entry_fmt, data, offset_tables_start + bucket_offset + j * offset_entry_size)
+            start = glyph_table_start + glyph_offset
+            if start + GLYPH_HEADER_SIZE > len(data):
+                raise ValueError(f'Glyph for codepoint {codepoint} is out of bounds')
+            end = start + glyph_record_size(data, start)
+            if end > len(data):
+                raise ValueError(f'Glyph for codepoint {codepoint} is out of bounds')
+            # the firmware uses the first entry of a duplicated codepoint
+            glyphs.setdefault(codepoint, data[start:end])
+    if number_of_entries != number_of_glyphs:
+        raise ValueError(f'Font resource declares {number_of_glyphs} glyphs but has {number_of_entries}')
+    return glyphs
+
+
+def read_font_resource(path: str, key: str) -> bytes:
+    """Reads font resource `key` (e.g. '001') from a .pbl file or a directory of built resources"""
+    if os.path.isdir(path):
+        with open(os.path.join(path, key), 'rb') as f:
+            return f.read()
+    with open(path, 'rb') as f:
+        _, _, _, entries = ResourcePack.deserialize_table(f)
+        if int(key) >= len(entries):
+            raise Exception(f'{path} has no resource {key}')
+        return ResourcePack.read_entry(f, entries[int(key)])
+
+
+def file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+# path -> sha256 of a font source file, every size of a font shares it
+_source_hashes: dict[str, str] = {}
+
+
+def source_hash(path: str) -> str:
+    """file_hash of a font source, computed once per process"""
+    if path not in _source_hashes:
+        _source_hashes[path] = file_hash(path)
+    return _source_hashes[path]
+
+
+# path -> ctypes view of a copy-on-write memory map of the font file
+_font_buffers: dict[str, ctypes.Array] = {}
+
+
+def open_font_buffer(path: str) -> ctypes.Array:
+    """
+    Maps the font file once per process. Every face made from it reads the
+    same page cache pages, which forked or spawned workers share as well.
+    """
+    if path not in _font_buffers:
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        # the view holds a reference to the map, which stays open as long as the view lives
+        _font_buffers[path] = (ctypes.c_ubyte * len(mapped)).from_buffer(mapped)
+    return _font_buffers[path]
+
+
+class FontBufferReader:
+    """
+    Stream handed to freetype.Face, which creates the face from the buffer
+    returned by read() without copying and keeps it alive with the face.
+    """
+    def __init__(self, buffer: ctypes.Array):
+        self.buffer = buffer
+
+    def read(self) -> ctypes.Array:
+        return self.buffer
+
+
+# (font type, file hash) -> {codepoint: glyph index}
+_coverage_cache: dict[tuple['FontType', str], dict[int, int]] = {}
+
+
 class FontType(Enum):
     TTF = 1
     PBFF = 2
     MERGED = 3
+    RESOURCE = 4  # glyph records of a built font resource, copied as is
 
 
 class Font:
@@ -148,7 +298,9 @@ class Font:
                  pbff_path: str,
                  height: int,
                  max_glyphs: int,
-                 legacy=False):
+                 legacy=False,
+                 resource_path: str = '',
+                 resource_key: str = ''):
         self.version = FONT_VERSION_2
         self.type = font_type
         self.ttf_path = ttf_path
@@ -156,13 +308,20 @@ class Font:
         self.max_height = int(height)
         self.legacy = legacy
         if self.ttf_path != '':
-            self.face = freetype.Face(self.ttf_path)
+            self.face = freetype.Face(FontBufferReader(open_font_buffer(self.ttf_path)))
             self.face.set_pixel_sizes(0, self.max_height)
             self.name = self.face.family_name + b'_' + self.face.style_name
         if self.pbff_path != '':
-            self.pbff_glyphs: dict[int, dict[str, Any]] = load_pbff_file(pbff_path)
-            self.pbff_glyphs_list = list(self.pbff_glyphs.items())
-            self.pbff_glyphs_list_cursor_index = 0
+            self.pbff_glyphs: dict[int, Glyph] = load_pbff_file(pbff_path)
+        self.resource_path = resource_path
+        if self.resource_path != '':
+            resource = read_font_resource(resource_path, resource_key)
+            self.resource_hash = hashlib.sha256(resource).hexdigest()
+            self.resource_glyphs: dict[int, bytes] = load_font_resource(resource)
+            resource_height = struct.unpack_from(FONT_INFO_FMT, resource)[1]
+            if resource_height != self.max_height:
+                print(f'warning: resource {resource_key} of {resource_path} has height {resource_height}, '
+                      f'its glyphs are copied into a font of height {self.max_height}')
         self.wildcard_codepoint = WILDCARD_CODEPOINT
         self.number_of_glyphs = 0
         self.table_size = HASH_TABLE_SIZE
@@ -176,6 +335,8 @@ class Font:
         self.offset_tables = [[] for _ in range(self.table_size)]
         self.heightoffset = 0
         self.fauxbold = False
+        self.trim = False
+        self.trimmed_bytes = 0
 
     def set_tracking_adjust(self, adjust):
         self.tracking_adjust = adjust
@@ -186,6 +347,17 @@ class Font:
     def set_fauxbold(self, fauxbold):
         self.fauxbold = fauxbold
 
+    def set_trim(self, trim):
+        self.trim = trim
+
+    def trim_glyph(self, glyph: Glyph) -> Glyph:
+        """Crops the glyph to its ink and moves its offsets so it renders the same"""
+        if not self.trim:
+            return glyph
+        trimmed = glyph.trim()
+        self.trimmed_bytes += glyph.record_size() - trimmed.record_size()
+        return trimmed
+
     def set_regex_filter(self, regex_string):
         if regex_string != ".*":
             try:
@@ -198,69 +370,50 @@ class Font:
     def set_codepoint_list(self, list_path):
         with open(list_path, "r", encoding="utf-8") as codepoints_file:
             codepoints_json = json.load(codepoints_file)
-            self.codepoints = [int(cp) for cp in codepoints_json["codepoints"]]
-
-    def is_supported_glyph(self, codepoint):
-        return (self.face.get_char_index(codepoint) > 0 or (codepoint == self.wildcard_codepoint))
-    
-    def get_first_char(self) -> tuple[int, int]:
-        if self.type == FontType.TTF:
-            (codepoint, gindex) = self.face.get_first_char()
-            return int(codepoint), gindex
-        else:
-            self.pbff_glyphs_list_cursor_index = 1
-            try:
-                codepoint = self.pbff_glyphs_list[self.pbff_glyphs_list_cursor_index][0]
-            except IndexError:
-                return 0, 0
-            gindex = 1
-            return codepoint, gindex
-        
-    def get_next_char(self, codepoint, gindex) -> tuple[int, int]:
-        if self.type == FontType.TTF:
-            (codepoint, gindex) = self.face.get_next_char(codepoint, gindex)
-            return int(codepoint), gindex
+            self.codepoints = {int(cp) for cp in codepoints_json["codepoints"]}
+
+    def coverage(self) -> dict[int, int]:
+        """
+        Codepoint -> glyph index of every glyph in the font source, in font
+        order. Cached by file hash, so every size of a TTF shares one cmap scan.
+        """
+        if self.type == FontType.RESOURCE:
+            key = (self.type, self.resource_hash)
         else:
-            self.pbff_glyphs_list_cursor_index += 1
-            try:
-                codepoint = self.pbff_glyphs_list[self.pbff_glyphs_list_cursor_index][0]
-            except IndexError:
-                self.pbff_glyphs_list_cursor_index = 0
-                return 0, 0
-            gindex = self.pbff_glyphs_list_cursor_index
-            return codepoint, gindex
-    
+            key = (self.type, source_hash(self.ttf_path if self.type == FontType.TTF else self.pbff_path))
+        if key not in _coverage_cache:
+            if self.type == FontType.RESOURCE:
+                # codepoints sharing an identical glyph record share an index
+                records = {}
+                index = {codepoint: records.setdefault(record, len(records) + 1)
+                         for codepoint, record in self.resource_glyphs.items()}
+            elif self.type == FontType.TTF:
+                index = {}
+                (codepoint, gindex) = self.face.get_first_char()
+                while gindex:
+                    index[int(codepoint)] = gindex
+                    (codepoint, gindex) = self.face.get_next_char(codepoint, gindex)
+            else:
+                index = {codepoint: gindex for gindex, codepoint in enumerate(self.pbff_glyphs, start=1)}
+            _coverage_cache[key] = index
+        return _coverage_cache[key]
+
+    def uncovered_codepoints(self) -> list[int]:
+        """Requested codepoints the font source has no glyph for"""
+        if isinstance(self.codepoints, range):
+            # no codepoint list was set, everything the font has is requested
+            return []
+        coverage = self.coverage()
+        return sorted(cp for cp in self.codepoints
+                      if cp not in coverage and (self.regex is None or self.regex.match(chr(cp))))
+
     def glyph_bits_pbff(self, codepoint) -> bytes:
-        def get_bytes(bits):
-            while len(bits):
-                item = 0
-                for x in range(8):
-                    item <<= 1
-                    item += bits.pop(7 - x)
-                yield item
-
-        glyph = self.pbff_glyphs[codepoint]
-        glyph_header = struct.pack('<BBbbb',
-                                   glyph['width'],
-                                   glyph['height'],
-                                   glyph['left'],
-                                   glyph['top'],
-                                   glyph['advance'])
-        bits = sum(glyph['data'], [])
-        try:
-            assert len(bits) == glyph['width'] * glyph['height']
-        except AssertionError as ae:
-            print(f'codepoint {codepoint} in {self.pbff_path} has wrong number of bits or dimensions, check Space paddings in it')
-            raise ae
-        while (len(bits) % 32):
-            bits = bits + [False]
-        glyph_packed = []
-        for byte in get_bytes(bits):
-            glyph_packed.append(struct.pack('<B', byte))
-
-        return glyph_header + b''.join(glyph_packed)
-
-    def glyph_bits_ttf(self, gindex):
+        return self.trim_glyph(self.pbff_glyphs[codepoint]).pack()
+
+    def glyph_bits_resource(self, codepoint) -> bytes:
+        return self.resource_glyphs[codepoint]
+
+    def glyph_ttf(self, gindex) -> Glyph:
         flags = (freetype.FT_LOAD_RENDER if self.legacy else
                  freetype.FT_LOAD_RENDER | freetype.FT_LOAD_MONOCHROME | freetype.FT_LOAD_TARGET_MONO)
         self.face.load_glyph(gindex, flags)
@@ -268,60 +421,34 @@ class Font:
         advance = self.face.glyph.advance.x / 64  # Convert 26.6 fixed float format to px
         advance += self.tracking_adjust
         width = bitmap.width
-        if self.fauxbold:
-            width += 1
-        fauxbold_additional_byte = (bitmap.width % 8 == 0)
-        height = bitmap.rows
         left = self.face.glyph.bitmap_left
         bottom = self.max_height - self.face.glyph.bitmap_top + self.heightoffset
-        pixel_mode = self.face.glyph.bitmap.pixel_mode
-
-        glyph_structure = ''.join((
-            '<',  # little_endian
-            'B',  # bitmap_width
-            'B',  # bitmap_height
-            'b',  # offset_left
-            'b',  # offset_top
-            'b'   # horizontal_advance
-        ))
-        glyph_header = struct.pack(glyph_structure, width, height, left, bottom, int(advance))
-
-        glyph_bitmap = []
+        pixel_mode = bitmap.pixel_mode
+        buffer = bytes(bitmap.buffer)
 
-        if pixel_mode == 1 and self.fauxbold:  # faux bold monochrome font, 1 bit per pixel
+        rows = []
+        if pixel_mode == 1:  # monochrome font, 1 bit per pixel, MSB first
             for i in range(bitmap.rows):
-                row = []
-                previousbyte = 0
-                for j in range(bitmap.pitch):
-                    byte = bitmap.buffer[i * bitmap.pitch + j] | previousbyte
-                    fauxboldbyte = byte | byte >> 1
-                    row.extend(bits(fauxboldbyte))
-                    previousbyte = byte << 8  # shift 8 bits for next
-                if fauxbold_additional_byte:
-                    byte = previousbyte
-                    fauxboldbyte = byte | byte >> 1
-                    row.extend(bits(fauxboldbyte))
-                glyph_bitmap.extend(row[:width])
-        elif pixel_mode == 1:  # monochrome font, 1 bit per pixel
+                row_bytes = buffer[i * bitmap.pitch:(i + 1) * bitmap.pitch]
+                rows.append(int.from_bytes(row_bytes.translate(REVERSED_BITS), 'little'))
+        elif pixel_mode == 2:  # grey font, 1 byte per pixel
             for i in range(bitmap.rows):
-                row = []
-                for j in range(bitmap.pitch):
-                    row.extend(bits(bitmap.buffer[i * bitmap.pitch + j]))
-                glyph_bitmap.extend(row[:bitmap.width])
-        elif pixel_mode == 2:  # grey font, 255 bits per pixel
-            for val in bitmap.buffer:
-                glyph_bitmap.extend([1 if val > 127 else 0])
+                row = 0
+                for x, val in enumerate(buffer[i * bitmap.pitch:i * bitmap.pitch + width]):
+                    if val > 127:
+                        row |= 1 << x
+                rows.append(row)
         else:
             raise Exception("Unsupported pixel mode: {}".format(pixel_mode))
 
-        glyph_packed = []
-        for word in grouper(32, glyph_bitmap, 0):
-            w = 0
-            for index, bit in enumerate(word):
-                w |= bit << index
-            glyph_packed.append(struct.pack('<I', w))
+        if self.fauxbold:  # smear every pixel one to the right
+            width += 1
+            rows = [row | row << 1 for row in rows]
+
+        return Glyph(width, bitmap.rows, left, bottom, int(advance), rows)
 
-        return glyph_header + b''.join(glyph_packed)
+    def glyph_bits_ttf(self, gindex) -> bytes:
+        return self.trim_glyph(self.glyph_ttf(gindex)).pack()
 
     def fontinfo_bits(self):
         return struct.pack('<BBHHBB',
@@ -29,18 +29,19 @@
 class LinedFileReader():
     def __init__(self, fh):
         self.data = fh.readlines()
+        self.position = 0
         self.bytes_read = 0
 
     def empty(self):
-        return len(self.data) == 0
+        return self.position >= len(self.data)
 
     def next(self):
-        t = self.data[0]
-        del self.data[0]
+        t = self.data[self.position]
+        self.position += 1
         return t.replace('\n', '')
 
     def peek(self):
-        return self.data[0].replace('\n', '')
+        return self.data[self.position].replace('\n', '')
 
 
 class FileReader():
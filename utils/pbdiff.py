@@ -0,0 +1,99 @@
+import argparse
+import json
+import sys
+
+from utils.fontgen import load_font_resource
+from utils.pbpack import ResourcePack
+
+
+def diff_bytes(old: bytes, new: bytes) -> dict:
+    first_difference = next((i for i, (a, b) in enumerate(zip(old, new)) if a != b),
+                            min(len(old), len(new)))
+    return {
+        'kind': 'bytes',
+        'first_difference': first_difference,
+    }
+
+
+def diff_glyphs(old_glyphs: dict[int, bytes], new_glyphs: dict[int, bytes]) -> dict:
+    return {
+        'kind': 'font',
+        'added': sorted(new_glyphs.keys() - old_glyphs.keys()),
+        'removed': sorted(old_glyphs.keys() - new_glyphs.keys()),
+        'changed': sorted(cp for cp in old_glyphs.keys() & new_glyphs.keys()
+                          if old_glyphs[cp] != new_glyphs[cp]),
+    }
+
+
+def diff_contents(old: bytes, new: bytes) -> dict:
+    """Glyph-level diff for font resources, byte-level diff for the rest"""
+    try:
+        return diff_glyphs(load_font_resource(old), load_font_resource(new))
+    except ValueError:
+        return diff_bytes(old, new)
+
+
+def diff_packs(old_path: str, new_path: str) -> dict:
+    """
+    Compares two .pbl files by their table entries (length and stored CRC).
+    Contents are only read for entries that differ.
+    """
+    with open(old_path, 'rb') as old_f, open(new_path, 'rb') as new_f:
+        _, old_crc, _, old_entries = ResourcePack.deserialize_table(old_f)
+        _, new_crc, _, new_entries = ResourcePack.deserialize_table(new_f)
+
+        resources = []
+        unchanged = 0
+        for i in range(max(len(old_entries), len(new_entries))):
+            resource_id = i + 1
+            # the name of the resource in build/ and for `python -m utils.pbpack`
+            key = f"{i:03d}"
+            if i >= len(new_entries):
+                resources.append({'id': resource_id, 'key': key, 'status': 'removed',
+                                  'old_length': old_entries[i][1], 'old_crc': old_entries[i][2]})
+                continue
+            if i >= len(old_entries):
+                resources.append({'id': resource_id, 'key': key, 'status': 'added',
+                                  'new_length': new_entries[i][1], 'new_crc': new_entries[i][2]})
+                continue
+
+            _, old_length, old_entry_crc = old_entries[i]
+            _, new_length, new_entry_crc = new_entries[i]
+            if old_length == new_length and old_entry_crc == new_entry_crc:
+                unchanged += 1
+                continue
+
+            change = {
+                'id': resource_id,
+                'key': key,
+                'status': 'changed',
+                'old_length': old_length,
+                'new_length': new_length,
+                'old_crc': old_entry_crc,
+                'new_crc': new_entry_crc,
+            }
+            change.update(diff_contents(ResourcePack.read_entry(old_f, old_entries[i]),
+                                        ResourcePack.read_entry(new_f, new_entries[i])))
+            resources.append(change)
+
+    return {
+        'old': old_path,
+        'new': new_path,
+        'identical': not resources,
+        'old_crc': old_crc,
+        'new_crc': new_crc,
+        'unchanged': unchanged,
+        'resources': resources,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List the resources that differ between two .pbl files')
+    parser.add_argument('old', help='previous .pbl file')
+    parser.add_argument('new', help='new .pbl file')
+    args = parser.parse_args()
+
+    result = diff_packs(args.old, args.new)
+    json.dump(result, sys.stdout, indent=2)
+    print()
+    sys.exit(0 if result['identical'] else 1)
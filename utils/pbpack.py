@@ -1,6 +1,18 @@
 import utils.stm32_crc as stm32_crc
+import argparse
+import os
 import struct
-import time
+
+
+def source_date_epoch():
+    """ Returns the SOURCE_DATE_EPOCH timestamp if it is set, else None.
+
+        See https://reproducible-builds.org/specs/source-date-epoch/
+    """
+    value = os.environ.get('SOURCE_DATE_EPOCH')
+    if not value:
+        return None
+    return int(value) & 0xffffffff
 
 
 class ResourcePack(object):
@@ -18,6 +30,7 @@ class ResourcePack(object):
     MANIFEST_FMT = '<III'
     MANIFEST_SIZE_BYTES = 12
     CONTENT_START_OFFSET = MANIFEST_SIZE_BYTES +  MAX_NUM_FILES * TABLE_ENTRY_SIZE_BYTES
+    COPY_CHUNK_SIZE = 1 << 20
 
     def serialize_manifest(self, crc=None, timestamp=None):
         if crc is None:
@@ -25,6 +38,10 @@ class ResourcePack(object):
             crc = stm32_crc.crc32(all_contents)
         if timestamp is None:
             timestamp = self.timestamp
+        if timestamp is None:
+            # No fixed timestamp: derive it from the contents so identical
+            # inputs always produce an identical pack
+            timestamp = crc
         fmt = self.MANIFEST_FMT
         return struct.pack(fmt, len(self.table), crc, timestamp)
 
@@ -70,16 +87,20 @@ class ResourcePack(object):
         return b"".join(self.contents)
 
     @classmethod
-    def deserialize(cls, f_in):
+    def deserialize_table(cls, f_in):
+        """ Parses the manifest and table entries of a pack without reading
+            any of the contents.
+
+            Returns a (num_files, crc, timestamp, table_entries) tuple where
+            table_entries is a list of (offset, length, crc) tuples.
+        """
         # Parse manifest:
         manifest = f_in.read(cls.MANIFEST_SIZE_BYTES)
         fmt = cls.MANIFEST_FMT
-        (num_files, crc, timestamp) = struct.unpack(fmt, manifest)
-
-        resource_pack = cls()
+        (num_files, pack_crc, timestamp) = struct.unpack(fmt, manifest)
 
         # Parse table entries:
-        resource_pack.table_entries = []
+        table_entries = []
         for n in range(num_files):
             table_entry = f_in.read(cls.TABLE_ENTRY_SIZE_BYTES)
             fmt = cls.TABLE_ENTRY_FMT
@@ -89,21 +110,36 @@ class ResourcePack(object):
             if file_id != n + 1:
                 raise Exception("File ID is expected to be %u, but was %u" %
                                 (n + 1, file_id))
-            resource_pack.table_entries.append((offset, length, crc))
-        if len(resource_pack.table_entries) != num_files:
+            table_entries.append((offset, length, crc))
+        if len(table_entries) != num_files:
             raise Exception("Number of files in manifest is %u, but actual"
-                            "number is %u" % (num_files, n))
+                            "number is %u" % (num_files, len(table_entries)))
 
-        # Fetch the contents:
-        for entry in resource_pack.table_entries:
-            offset, length, crc = entry
-            f_in.seek(offset + cls.CONTENT_START_OFFSET)
-            content = f_in.read(length)
+        return num_files, pack_crc, timestamp, table_entries
+
+    @classmethod
+    def read_entry(cls, f_in, entry, verify=True):
+        """ Reads the contents of a single table entry. """
+        offset, length, crc = entry
+        f_in.seek(offset + cls.CONTENT_START_OFFSET)
+        content = f_in.read(length)
+        if verify:
             calculated_crc = stm32_crc.crc32(content)
             if calculated_crc != crc:
                 raise Exception("Entry %s does not match CRC of content (0x%x)"
                                 % (entry, calculated_crc))
-            resource_pack.contents.append(content)
+        return content
+
+    @classmethod
+    def deserialize(cls, f_in):
+        num_files, _, timestamp, table_entries = cls.deserialize_table(f_in)
+
+        resource_pack = cls()
+        resource_pack.table_entries = table_entries
+
+        # Fetch the contents:
+        for entry in resource_pack.table_entries:
+            resource_pack.contents.append(cls.read_entry(f_in, entry))
 
         resource_pack.num_files = num_files
         resource_pack.timestamp = timestamp
@@ -119,6 +155,123 @@ class ResourcePack(object):
         f_out.write(all_contents)
         return crc
 
+    @classmethod
+    def _same_content(cls, f_in, a, b, new_content):
+        # a and b are (offset, length, crc) entries of f_in, or None for new_content
+        if a is not None and b is not None and a[:2] == b[:2]:
+            return True
+        a_length, a_crc = (len(new_content), None) if a is None else a[1:]
+        b_length, b_crc = (len(new_content), None) if b is None else b[1:]
+        if a_length != b_length:
+            return False
+        a_crc = stm32_crc.crc32(new_content) if a_crc is None else a_crc
+        b_crc = stm32_crc.crc32(new_content) if b_crc is None else b_crc
+        if a_crc != b_crc:
+            return False
+        a_content = new_content if a is None else cls.read_entry(f_in, a, verify=False)
+        b_content = new_content if b is None else cls.read_entry(f_in, b, verify=False)
+        return a_content == b_content
+
+    @classmethod
+    def replace_resource(cls, in_path, out_path, file_id, content):
+        """ Writes the pack at in_path to out_path with resource file_id
+            (1-based) replaced by content, or appended if file_id is one past
+            the last resource. The output is identical to serializing the
+            whole pack again.
+
+            Only the new content is CRC'd. Unchanged contents keep the CRC
+            stored in the table, which is also combined into the pack CRC
+            when they are word aligned, so their bytes are only read to copy
+            them. in_path and out_path may be the same file.
+
+            Returns the pack CRC.
+        """
+        with open(in_path, 'rb') as f_in:
+            num_files, _, _, entries = cls.deserialize_table(f_in)
+            if not 1 <= file_id <= num_files + 1:
+                raise Exception("Resource %u does not exist and cannot be appended "
+                                "to a pack of %u resources" % (file_id, num_files))
+            if file_id > cls.MAX_NUM_FILES:
+                raise Exception("Exceeded max number of resources. Must have %d or "
+                                "fewer" % cls.MAX_NUM_FILES)
+
+            # None stands for the new content
+            resources = list(entries)
+            if file_id == num_files + 1:
+                resources.append(None)
+            else:
+                resources[file_id - 1] = None
+
+            # Lay out unique contents in order of first use, as add_resource does
+            segments = []
+            table_ids = []
+            for resource in resources:
+                length = len(content) if resource is None else resource[1]
+                table_id = None
+                if length != 0:
+                    for i, segment in enumerate(segments):
+                        if cls._same_content(f_in, segment, resource, content):
+                            table_id = i
+                            break
+                if table_id is None:
+                    segments.append(resource)
+                    table_id = len(segments) - 1
+                table_ids.append(table_id)
+            if table_ids[-1] in table_ids[:-1]:
+                raise Exception("The last resource cannot be identical to a previous one")
+
+            content_crc = stm32_crc.crc32(content)
+            segment_offsets = []
+            offset = 0
+            for segment in segments:
+                segment_offsets.append(offset)
+                offset += len(content) if segment is None else segment[1]
+
+            table = b''
+            for cur_file_id, table_id in enumerate(table_ids, start=1):
+                segment = segments[table_id]
+                length, crc = (len(content), content_crc) if segment is None else segment[1:]
+                table += struct.pack(cls.TABLE_ENTRY_FMT, cur_file_id, segment_offsets[table_id], length, crc)
+            table += struct.pack(cls.TABLE_ENTRY_FMT, 0, 0, 0, 0) * (cls.MAX_NUM_FILES - len(table_ids))
+
+            # Pack CRC over the contents, combining stored CRCs where possible
+            pack_crc = 0xffffffff
+            pending = b''
+            for i, segment in enumerate(segments):
+                is_last = i == len(segments) - 1
+                if segment is not None and not pending and (segment[1] % 4 == 0 or is_last):
+                    pack_crc = stm32_crc.crc32_combine(pack_crc, segment[2], segment[1])
+                    continue
+                data = pending + (content if segment is None else cls.read_entry(f_in, segment, verify=False))
+                whole = len(data) - len(data) % 4
+                pack_crc = stm32_crc.process_buffer(data[:whole], pack_crc)
+                pending = data[whole:]
+            if pending:
+                pack_crc = stm32_crc.process_buffer(pending, pack_crc)
+
+            timestamp = source_date_epoch()
+            if timestamp is None:
+                timestamp = pack_crc
+
+            tmp_path = str(out_path) + '.tmp'
+            with open(tmp_path, 'wb') as f_out:
+                f_out.write(struct.pack(cls.MANIFEST_FMT, len(table_ids), pack_crc, timestamp))
+                f_out.write(table)
+                for segment in segments:
+                    if segment is None:
+                        f_out.write(content)
+                        continue
+                    offset, length, _ = segment
+                    f_in.seek(offset + cls.CONTENT_START_OFFSET)
+                    while length:
+                        chunk = f_in.read(min(length, cls.COPY_CHUNK_SIZE))
+                        if not chunk:
+                            raise Exception("Pack %s is truncated" % in_path)
+                        f_out.write(chunk)
+                        length -= len(chunk)
+        os.replace(tmp_path, out_path)
+        return pack_crc
+
     def add_resource(self, content):
         index = -1
         # if resource already is present, add to table only
@@ -134,8 +287,22 @@ class ResourcePack(object):
 
     def __init__(self):
         self.num_files = 0
-        self.timestamp = int(time.time())
+        self.timestamp = source_date_epoch()
         self.contents = []
         self.table_entries = []
         self.table = []
         self.is_v2 = True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replace or append one resource of a .pbl file')
+    parser.add_argument('pack', help='existing .pbl file')
+    parser.add_argument('key', help='resource name as in build/, e.g. 000 for the translation')
+    parser.add_argument('file', help='new content of the resource')
+    parser.add_argument('-o', '--output', help='output .pbl file, the input is updated if omitted')
+    args = parser.parse_args()
+
+    with open(args.file, 'rb') as f:
+        new_content = f.read()
+    crc = ResourcePack.replace_resource(args.pack, args.output or args.pack, int(args.key) + 1, new_content)
+    print("Replaced resource %s, pack CRC 0x%08x" % (args.key, crc))
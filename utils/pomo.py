@@ -0,0 +1,192 @@
+"""
+Compiles gettext .po files to the GNU MO format, byte compatible with
+`msgfmt` output (including the hash table used for lookups on the watch).
+"""
+
+import argparse
+import re
+import struct
+
+MO_MAGIC = 0x950412de
+MO_REVISION = 0
+MO_HEADER_FMT = '<IIIIIII'
+MO_HEADER_SIZE = struct.calcsize(MO_HEADER_FMT)
+CONTEXT_SEPARATOR = '\x04'
+
+ESCAPES = {
+    'n': '\n', 't': '\t', 'r': '\r', 'a': '\a', 'b': '\b', 'f': '\f', 'v': '\v',
+    '\\': '\\', '"': '"', "'": "'", '?': '?',
+}
+
+
+def unescape(s: str) -> str:
+    def replace(m):
+        escape = m.group(1)
+        if escape in ESCAPES:
+            return ESCAPES[escape]
+        if escape[0] == 'x':
+            return chr(int(escape[1:], 16))
+        return chr(int(escape, 8))
+    return re.sub(r'\\(x[0-9a-fA-F]+|[0-7]{1,3}|.)', replace, s)
+
+
+def load_po_file(path: str) -> list[tuple[str, str]]:
+    """
+    Parses a .po file into (key, translation) pairs as they are stored in
+    a MO file: the key is msgid (prefixed by msgctxt and \\x04 if present,
+    followed by \\0 and msgid_plural for plurals) and plural translations
+    are joined by \\0. Fuzzy, obsolete and untranslated entries are skipped,
+    the same as msgfmt does.
+    """
+    messages = []
+    entry = {}
+    fuzzy = False
+    field = None
+
+    def flush():
+        nonlocal entry, fuzzy
+        if 'msgid' in entry:
+            msgstrs = entry.get('msgstr', [])
+            translated = any(msgstrs)
+            # the header entry is kept even when it is fuzzy
+            if translated and (not fuzzy or entry['msgid'] == ''):
+                key = entry['msgid']
+                if 'msgid_plural' in entry:
+                    key += '\0' + entry['msgid_plural']
+                if 'msgctxt' in entry:
+                    key = entry['msgctxt'] + CONTEXT_SEPARATOR + key
+                messages.append((key, '\0'.join(msgstrs)))
+        entry = {}
+        fuzzy = False
+
+    with open(path, 'r', encoding='utf-8') as fh:
+        for lineno, line in enumerate(fh, start=1):
+            line = line.strip()
+            if line.startswith('#') or line == '':
+                # comments precede the entry they apply to
+                if 'msgstr' in entry:
+                    flush()
+                if line.startswith('#,') and 'fuzzy' in line:
+                    fuzzy = True
+                continue
+
+            r = re.match(r'^(msgctxt|msgid|msgid_plural|msgstr(?:\[\d+\])?)\s+"(.*)"$', line)
+            if r:
+                field = r.group(1)
+                if field in ('msgctxt', 'msgid') and 'msgstr' in entry:
+                    flush()
+                if field.startswith('msgstr'):
+                    entry.setdefault('msgstr', [])
+                    entry['msgstr'].append(unescape(r.group(2)))
+                else:
+                    entry[field] = unescape(r.group(2))
+                continue
+
+            r = re.match(r'^"(.*)"$', line)
+            if r and field is not None:
+                if field.startswith('msgstr'):
+                    entry['msgstr'][-1] += unescape(r.group(1))
+                else:
+                    entry[field] += unescape(r.group(1))
+                continue
+
+            raise Exception(f'{path}:{lineno}: invalid line: {line}')
+    flush()
+    return messages
+
+
+def hash_string(s: bytes) -> int:
+    """hashpjw, as used by gettext for the MO hash table"""
+    hval = 0
+    for c in s:
+        hval = (hval << 4) + c
+        g = hval & 0xf0000000
+        if g:
+            hval ^= g >> 24
+            hval ^= g
+    return hval
+
+
+def is_prime(n: int) -> bool:
+    if n < 2:
+        return False
+    divisor = 2
+    while divisor * divisor <= n:
+        if n % divisor == 0:
+            return False
+        divisor += 1
+    return True
+
+
+def hash_table_size(number_of_strings: int) -> int:
+    size = (number_of_strings * 4 // 3) | 1
+    while not is_prime(size):
+        size += 2
+    return max(size, 3)
+
+
+def compile_mo(messages: list[tuple[str, str]]) -> bytes:
+    """Serializes (key, translation) pairs to the GNU MO layout"""
+    entries = sorted((key.encode('utf-8'), value.encode('utf-8')) for key, value in messages)
+    n = len(entries)
+    hash_size = hash_table_size(n)
+    originals_offset = MO_HEADER_SIZE
+    translations_offset = originals_offset + n * 8
+    hash_offset = translations_offset + n * 8
+    strings_offset = hash_offset + hash_size * 4
+
+    hash_table = [0] * hash_size
+    for i, (key, _) in enumerate(entries):
+        hval = hash_string(key.split(b'\0', 1)[0])
+        idx = hval % hash_size
+        incr = 1 + (hval % (hash_size - 2))
+        while hash_table[idx] != 0:
+            idx += incr
+            if idx >= hash_size:
+                idx -= hash_size
+        hash_table[idx] = i + 1
+
+    originals = []
+    translations = []
+    strings = bytearray()
+    for column, descriptors in ((0, originals), (1, translations)):
+        for entry in entries:
+            descriptors.append(struct.pack('<II', len(entry[column]), strings_offset + len(strings)))
+            strings += entry[column] + b'\0'
+
+    header = struct.pack(MO_HEADER_FMT, MO_MAGIC, MO_REVISION, n,
+                         originals_offset, translations_offset, hash_size, hash_offset)
+    return (header + b''.join(originals) + b''.join(translations)
+            + struct.pack(f'<{hash_size}I', *hash_table) + bytes(strings))
+
+
+def compile_po_file(path: str) -> bytes:
+    return compile_mo(load_po_file(path))
+
+
+def load_mo(data: bytes) -> list[tuple[str, str]]:
+    """Reads the (key, translation) pairs back from a MO file"""
+    if len(data) < MO_HEADER_SIZE:
+        raise ValueError('MO file is too short')
+    (magic, _, n, originals_offset,
+     translations_offset, _, _) = struct.unpack_from(MO_HEADER_FMT, data)
+    if magic != MO_MAGIC:
+        raise ValueError(f'Invalid MO magic 0x{magic:08x}')
+
+    def string(descriptors_offset, i):
+        length, offset = struct.unpack_from('<II', data, descriptors_offset + i * 8)
+        if offset + length > len(data):
+            raise ValueError(f'MO string {i} is out of bounds')
+        return data[offset:offset + length].decode('utf-8')
+
+    return [(string(originals_offset, i), string(translations_offset, i)) for i in range(n)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile a .po file to a MO file')
+    parser.add_argument('po', help='input .po file')
+    parser.add_argument('-o', '--output', required=True, help='output MO file')
+    args = parser.parse_args()
+
+    with open(args.output, 'wb') as f:
+        f.write(compile_po_file(args.po))
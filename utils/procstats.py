@@ -0,0 +1,40 @@
+import os
+import sys
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss_kib() -> int:
+    """Peak resident set size of this process in KiB, 0 if unknown"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def rss_kib() -> dict[str, int]:
+    """
+    Current resident set size of this process in KiB, split into anonymous
+    (private) and file backed (shareable) pages where the OS reports it.
+    """
+    status_path = f'/proc/{os.getpid()}/status'
+    if not os.path.exists(status_path):
+        return {'VmRSS': peak_rss_kib()}
+    rss = {}
+    with open(status_path, 'r') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('VmRSS', 'VmHWM', 'RssAnon', 'RssFile', 'RssShmem'):
+                rss[name] = int(value.split()[0])
+    return rss
+
+
+def format_rss() -> str:
+    rss = rss_kib()
+    text = f"RSS {rss['VmRSS'] / 1024:.1f} MiB"
+    if 'RssAnon' in rss:
+        text += f" (private {rss['RssAnon'] / 1024:.1f} MiB, file backed {rss['RssFile'] / 1024:.1f} MiB)"
+    return text
@@ -0,0 +1,216 @@
+"""
+End-to-end scaling and limits harness. Generates synthetic PBFF fonts and
+codepoint lists, runs build.py on them at increasing glyph counts, records
+build time and peak memory, and checks that every font resource of the
+resulting pack stays within the font format limits.
+
+    python -m utils.scaling --glyphs 1000 5000 15000 32000 --distribution random
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import utils.fontgen as fg
+from utils.pbpack import ResourcePack
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+PBFF_SIZES = ('14', '14_bold', '18', '18_bold', '24', '24_bold', '28', '28_bold')
+FONT_RESOURCE_IDS = range(2, 10)  # resources 001-008
+FONT_NAME = 'synthetic'
+
+DISTRIBUTIONS = {
+    # name: (first codepoint, step)
+    'contiguous': (0x4E00, 1),  # one dense block, CJK ideographs
+    'random': None,  # uniform over the BMP
+    'astral': (0x20000, 1),  # CJK Extension B, needs 4 byte codepoints
+    'colliding': (0x4E00, fg.HASH_TABLE_SIZE),  # every codepoint in the same hash bucket
+}
+
+
+def usable_codepoint(codepoint: int) -> bool:
+    """Codepoints that can be listed in a lang/*.txt file"""
+    if codepoint in (fg.WILDCARD_CODEPOINT, fg.ELLIPSIS_CODEPOINT, ord('#')):
+        return False
+    if 0xD800 <= codepoint <= 0xDFFF:
+        return False
+    char = chr(codepoint)
+    return char.isprintable() and not char.isspace()
+
+
+def generate_codepoints(count: int, distribution: str, rng: random.Random) -> list[int]:
+    if distribution == 'random':
+        candidates = [cp for cp in range(fg.MIN_CODEPOINT, fg.MAX_2_BYTES_CODEPOINT + 1) if usable_codepoint(cp)]
+        return sorted(rng.sample(candidates, min(count, len(candidates))))
+    start, step = DISTRIBUTIONS[distribution]
+    codepoints = []
+    codepoint = start
+    while len(codepoints) < count and codepoint <= fg.MAX_EXTENDED_CODEPOINT:
+        if usable_codepoint(codepoint):
+            codepoints.append(codepoint)
+        codepoint += step
+    return codepoints
+
+
+def random_glyph(rng: random.Random, max_width: int, max_height: int) -> list[str]:
+    width = rng.randint(1, max_width)
+    rows = [''.join(rng.choice(' #') for _ in range(width)) for _ in range(rng.randint(1, max_height))]
+    rows[0] = '#' + rows[0][1:]
+    return [row.rstrip() for row in rows]
+
+
+def write_pbff(path: Path, codepoints: list[int], line_height: int, rng: random.Random):
+    lines = ['version 2', f'fallback {fg.WILDCARD_CODEPOINT}', f'line-height {line_height}']
+    max_width = max(2, line_height * 2 // 3)
+    max_height = line_height
+    for codepoint in [fg.WILDCARD_CODEPOINT] + codepoints:
+        lines.append(f'glyph {codepoint}')
+        lines.append('-' * (max_width + 1) + f' {rng.randint(0, 4)}')
+        lines += random_glyph(rng, max_width, max_height)
+        lines.append('-')
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def write_workdir(workdir: Path, codepoints: list[int], rng: random.Random):
+    """Lays out lang/, pbff/ and translation/ the way build.py expects them"""
+    lang_dir = workdir / 'lang'
+    lang_dir.mkdir()
+    (lang_dir / 'unicodes.json').write_text('[]')
+    chars = ''.join(chr(cp) for cp in codepoints)
+    lines = [chars[i:i + 64] for i in range(0, len(chars), 64)]
+    (lang_dir / f'{FONT_NAME}.txt').write_text(f'#pbff: {FONT_NAME}\n' + '\n'.join(lines) + '\n', encoding='utf-8')
+
+    pbff_dir = workdir / 'pbff' / FONT_NAME
+    pbff_dir.mkdir(parents=True)
+    for size in PBFF_SIZES:
+        write_pbff(pbff_dir / f'{size}.pbff', codepoints, int(size.split('_')[0]), rng)
+
+    shutil.copytree(REPO_DIR / 'translation', workdir / 'translation')
+
+
+def run_build(workdir: Path, build_args: list[str]) -> tuple[int, float, int]:
+    """Runs build.py in workdir, returns (exit code, seconds, peak RSS in KiB)"""
+    with open(workdir / 'build.log', 'w') as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, str(REPO_DIR / 'build.py')] + build_args,
+                                cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            _, status, rusage = os.wait4(proc.pid, 0)
+            seconds = time.perf_counter() - start
+            exit_code = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is the largest child, which includes forked workers
+            peak_rss = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+        else:
+            exit_code = proc.wait()
+            seconds = time.perf_counter() - start
+            peak_rss = 0
+    return exit_code, seconds, peak_rss
+
+
+def check_pack(pack_path: Path, requested: set[int]) -> tuple[list[int], list[str]]:
+    """
+    Checks every font resource of the pack against the format limits.
+    Returns (glyph count per font resource, list of violations).
+    """
+    violations = []
+    glyph_counts = []
+    allowed = requested | {fg.WILDCARD_CODEPOINT, fg.ELLIPSIS_CODEPOINT}
+    info_size = struct.calcsize(fg.FONT_INFO_FMT)
+    hash_entry_size = struct.calcsize(fg.HASH_TABLE_ENTRY_FMT)
+    with open(pack_path, 'rb') as f:
+        num_files, _, _, entries = ResourcePack.deserialize_table(f)
+        if num_files > ResourcePack.MAX_NUM_FILES:
+            violations.append(f'{num_files} resources, the limit is {ResourcePack.MAX_NUM_FILES}')
+        for resource_id in FONT_RESOURCE_IDS:
+            content = ResourcePack.read_entry(f, entries[resource_id - 1])
+            (_, _, number_of_glyphs, _,
+             table_size, codepoint_bytes) = struct.unpack_from(fg.FONT_INFO_FMT, content)
+            glyph_counts.append(number_of_glyphs)
+            if number_of_glyphs > fg.MAX_GLYPHS_EXTENDED:
+                violations.append(f'resource {resource_id}: {number_of_glyphs} glyphs, the limit is {fg.MAX_GLYPHS_EXTENDED}')
+            expected_offset = 0
+            for i in range(table_size):
+                _, bucket_size, bucket_offset = struct.unpack_from(
+                    fg.HASH_TABLE_ENTRY_FMT, content, info_size + i * hash_entry_size)
+                if bucket_size > fg.OFFSET_TABLE_MAX_SIZE:
+                    violations.append(f'resource {resource_id}: hash bucket {i} has {bucket_size} entries, '
+                                      f'the limit is {fg.OFFSET_TABLE_MAX_SIZE}')
+                if bucket_offset != expected_offset:
+                    violations.append(f'resource {resource_id}: hash bucket {i} offset {bucket_offset} '
+                                      f'should be {expected_offset}, the 16 bit field overflowed')
+                    break
+                expected_offset += bucket_size * (fg.OFFSET_SIZE_BYTES + codepoint_bytes)
+            try:
+                glyphs = fg.load_font_resource(content)
+            except ValueError as e:
+                violations.append(f'resource {resource_id}: {e}')
+                continue
+            if len(glyphs) != number_of_glyphs:
+                violations.append(f'resource {resource_id}: {number_of_glyphs - len(glyphs)} duplicate codepoints')
+            unexpected = glyphs.keys() - allowed
+            if unexpected:
+                violations.append(f'resource {resource_id}: {len(unexpected)} glyphs that were not requested')
+    return glyph_counts, violations
+
+
+def run(glyph_counts: list[int], distribution: str, seed: int, build_args: list[str], keep: bool) -> list[dict]:
+    results = []
+    for count in glyph_counts:
+        rng = random.Random(seed)
+        codepoints = generate_codepoints(count, distribution, rng)
+        workdir = Path(tempfile.mkdtemp(prefix=f'pbl_scaling_{count}_'))
+        try:
+            write_workdir(workdir, codepoints, rng)
+            exit_code, seconds, peak_rss = run_build(workdir, build_args)
+            result = {
+                'requested': len(codepoints),
+                'distribution': distribution,
+                'exit_code': exit_code,
+                'seconds': round(seconds, 2),
+                'peak_rss_kib': peak_rss,
+            }
+            pack_path = workdir / 'build' / 'langpack.pbl'
+            if exit_code == 0:
+                packed, violations = check_pack(pack_path, set(codepoints))
+                result['pack_bytes'] = pack_path.stat().st_size
+                result['packed'] = min(packed)
+                result['violations'] = violations
+            else:
+                result['violations'] = [f'build failed, see {workdir / "build.log"}']
+                keep = True
+            results.append(result)
+            print(f"{len(codepoints):>6} glyphs: {seconds:8.2f} s, peak RSS {peak_rss / 1024:7.1f} MiB, "
+                  f"packed {result.get('packed', '-')}, "
+                  f"{'OK' if not result['violations'] else '; '.join(result['violations'][:3])}")
+        finally:
+            if not keep:
+                shutil.rmtree(workdir)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure build time and memory on synthetic fonts '
+                                                 'and check the output against the format limits')
+    parser.add_argument('--glyphs', type=int, nargs='+', default=[1000, 5000, 15000, 32000],
+                        help='number of requested codepoints per run')
+    parser.add_argument('--distribution', choices=sorted(DISTRIBUTIONS), default='random',
+                        help='how the requested codepoints are spread over Unicode')
+    parser.add_argument('--seed', type=int, default=0, help='seed for codepoints and glyph bitmaps')
+    parser.add_argument('--jobs', type=int, default=1, help='passed to build.py --jobs')
+    parser.add_argument('--keep', action='store_true', help='keep the generated work directories')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run(args.glyphs, args.distribution, args.seed, ['--jobs', str(args.jobs)], args.keep)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if any(result['violations'] for result in results) else 0)
@@ -31,24 +31,77 @@ def process_word(data, crc=0xffffffff):
     result = crc & 0xffffffff
     return result
 
-def process_buffer(buf, c = 0xffffffff):
-    word_count = len(buf) // 4
-    if (len(buf) % 4 != 0):
-        word_count += 1
+def _make_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 24
+        for i in range(8):
+            if (crc & 0x80000000) != 0:
+                crc = ((crc << 1) ^ CRC_POLY) & 0xffffffff
+            else:
+                crc = (crc << 1) & 0xffffffff
+        table.append(crc)
+    return table
+
+CRC_TABLE = _make_table()
 
+def process_buffer(buf, c = 0xffffffff):
+    # Table driven equivalent of process_word over every whole word
+    whole = len(buf) - len(buf) % 4
+    words = array.array('I', bytes(buf[:whole]))
+    if sys.byteorder != 'little':
+        words.byteswap()
+    table = CRC_TABLE
     crc = c
-    for i in range(0, word_count):
-        crc = process_word(buf[i * 4 : (i + 1) * 4], crc)
+    for d in words:
+        crc ^= d
+        crc = ((crc << 8) & 0xffffffff) ^ table[crc >> 24]
+        crc = ((crc << 8) & 0xffffffff) ^ table[crc >> 24]
+        crc = ((crc << 8) & 0xffffffff) ^ table[crc >> 24]
+        crc = ((crc << 8) & 0xffffffff) ^ table[crc >> 24]
+    if whole != len(buf):
+        crc = process_word(buf[whole:], crc)
     return crc
 
 def crc32(data):
     return process_buffer(data)
 
+def _gf2_matrix_times(mat, vec):
+    result = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            result ^= mat[i]
+        vec >>= 1
+        i += 1
+    return result
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, mat[i]) for i in range(32)]
+
+def crc32_combine(crc_a, crc_b, length_b):
+    """ CRC of A + B from crc32(A), crc32(B) and the length of B.
+
+        A must be a whole number of words long, B may end in a partial word.
+    """
+    # matrix of one zero word: column i is the CRC of 1 << i
+    mat = [process_word(b'\0\0\0\0', 1 << i) for i in range(32)]
+    words = (length_b + 3) // 4
+    crc = crc_a ^ 0xffffffff
+    while words:
+        if words & 1:
+            crc = _gf2_matrix_times(mat, crc)
+        words >>= 1
+        if words:
+            mat = _gf2_matrix_square(mat)
+    return crc ^ crc_b
+
 if __name__ == '__main__':
     assert 0x89f3bab2 == process_buffer(b"123 567 901 34")
     assert 0xaff19057 == process_buffer(b"123456789")
     assert 0x0519b130 == process_buffer(b"\xfe\xff\xfe\xff")
     assert 0x495e02ca == process_buffer(b"\xfe\xff\xfe\xff\x88")
+    assert process_buffer(b"123 567 901 34") == crc32_combine(crc32(b"123 567 "), crc32(b"901 34"), 6)
 
     print("All tests passed!")
 